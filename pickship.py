@@ -2,22 +2,51 @@
 
 
 import argparse
-import collections
+import concurrent.futures
+import functools
+import os
 import re
 import sys
 
 
+# Weights are kept as integer multiples of 1/WEIGHT_SCALE of a unit, so that
+# packing arithmetic is exact and fast.
+WEIGHT_SCALE = 1000
+
+
+def scale_weight(weight):
+    '''
+    Convert a weight in units (e.g. 4.3) to an int in 1/WEIGHT_SCALE units.
+    '''
+    return int(round(float(weight) * WEIGHT_SCALE))
+
+
+def format_weight(weight):
+    '''
+    Format an int weight in 1/WEIGHT_SCALE units as a decimal number of units.
+    '''
+    return str(weight / WEIGHT_SCALE)
+
+
 class Item:
+    __slots__ = ('code', 'name', 'weight')
+
     def __init__(self, code, name, weight):
+        '''
+        weight: int.  the item weight in 1/WEIGHT_SCALE units.
+        '''
         self.code = code
         self.name = name
         self.weight = weight
 
     def __repr__(self):
-        return "Item(%r, %r, %r)" % (self.code, self.name, self.weight)
+        return "Item(%r, %r, %s)" % (self.code, self.name,
+                                     format_weight(self.weight))
 
 
 class LineItem:
+    __slots__ = ('code', 'qty')
+
     def __init__(self, code, qty):
         '''
         code: str.  an Item code
@@ -31,6 +60,8 @@ class LineItem:
 
 
 class Order:
+    __slots__ = ('number', 'customer_code', 'line_items')
+
     def __init__(self, number, customer_code, line_items):
         self.number = number
         self.customer_code = customer_code
@@ -41,218 +72,480 @@ class Order:
                                       self.line_items)
 
 class Box:
-    def __init__(self, number, line_items, inventory):
+    __slots__ = ('number', 'line_items', 'weight')
+
+    def __init__(self, number, line_items, weight):
+        '''
+        weight: int.  the total weight of the line items, in 1/WEIGHT_SCALE
+          units.
+        '''
         self.number = number
         self.line_items = line_items
-        self.weight = 0
-        for li in line_items:
-            self.weight += inventory[li.code].weight * li.qty
+        self.weight = weight
 
     def __repr__(self):
         return 'Box: %r, %r' % (self.number, self.line_items)
 
 
 class PickShip:
-    def __init__(self, order_number, boxes):
+    __slots__ = ('order_number', 'boxes', 'weight')
+
+    def __init__(self, order_number, boxes, weight=None):
+        '''
+        weight: the total weight of the boxes, if already known.
+        '''
         self.order_number = order_number
         self.boxes = boxes
-        self.weight = sum(box.weight for box in boxes)
+        if weight is None:
+            weight = sum(box.weight for box in boxes)
+        self.weight = weight
     
     def __repr__(self):
         return 'PickShip(%r, %r)' % (self.order_number, self.boxes)
 
 
+# one ITEM START ... ITEM END block, as the inventory format lays it out: one
+# keyword per line, with no blank lines or extra whitespace.
+item_regex = re.compile(r'^ITEM START\n'
+                        r'CODE: (\S(?:[^\n]*\S)?)\n'
+                        r'NAME: (\S(?:[^\n]*\S)?)\n'
+                        r'WEIGHT: (\S(?:[^\n]*\S)?)\n'
+                        r'ITEM END\n', re.M)
+
+
 def read_inventory(filename):
     '''
     Parse an inventory file.
     Return a dict mapping item code to an Item.
     '''
+    with open(filename) as fh:
+        data = fh.read()
+
+    # Fast path: when every line between INVENTORY START and INVENTORY END
+    # belongs to an exactly laid out item block (5 lines each), build the
+    # inventory straight from one regex scan.
+    matches = item_regex.findall(data)
+    nlines = data.count('\n') + (not data.endswith('\n'))
+    if (nlines == 5 * len(matches) + 2 and
+            data.startswith('INVENTORY START\n') and
+            data.endswith(('\nINVENTORY END\n', '\nINVENTORY END'))):
+        return {code: Item(code, name,
+                           int(round(float(weight) * WEIGHT_SCALE)))
+                for code, name, weight in matches}
+
+    # Otherwise parse line by line, which allows blank lines and extra
+    # whitespace and reports what is wrong with a malformed file.
+    return parse_inventory_lines(data.split('\n'))
+
+
+def parse_inventory_lines(lines):
+    '''
+    Parse the lines of an inventory file one at a time.
+    Return a dict mapping item code to an Item.
+    '''
     inventory = {}
     # states
     START, INVENTORY, ITEM, CODE, NAME, WEIGHT, END = range(1, 8)
     state = START
-    with open(filename) as fh:
-        for line in fh:
-            line = line.strip()
-            if not line:
-                continue # skip blank lines
-
-            if state == START:
-                if line == 'INVENTORY START':
-                    state = INVENTORY
-                else:
-                    raise Exception("Missing INVENTORY START line.")
-            elif state == INVENTORY:
-                if line == 'INVENTORY END':
-                    state = END
-                elif line == 'ITEM START':
-                    state = ITEM
-                else:
-                    raise Exception("Missing ITEM START or INVENTORY END line.")
-            elif state == ITEM:
-                if line.startswith('CODE: '):
-                    state = CODE
-                    code = line.split(None, 1)[1]
-                else:
-                    raise Exception("Missing CODE line.")
-            elif state == CODE:
-                if line.startswith('NAME: '):
-                    state = NAME
-                    name = line.split(None, 1)[1]
-                else:
-                    raise Exception("Missing NAME line.")
-            elif state == NAME:
-                if line.startswith('WEIGHT: '):
-                    state = WEIGHT
-                    weight = float(line.split(None, 1)[1])
-                else:
-                    raise Exception("Missing WEIGHT line.")
-            elif state == WEIGHT:
-                if line == 'ITEM END':
-                    state = INVENTORY
-                    inventory[code] = Item(code, name, weight)
-                else:
-                    raise Exception("Missing ITEM END line.")
-            elif state == END:
-                raise Exception("Found a line after INVENTORY END line.")
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue # skip blank lines
+
+        if state == START:
+            if line == 'INVENTORY START':
+                state = INVENTORY
+            else:
+                raise Exception("Missing INVENTORY START line.")
+        elif state == INVENTORY:
+            if line == 'INVENTORY END':
+                state = END
+            elif line == 'ITEM START':
+                state = ITEM
+            else:
+                raise Exception("Missing ITEM START or INVENTORY END line.")
+        elif state == ITEM:
+            if line.startswith('CODE: '):
+                state = CODE
+                code = line.split(None, 1)[1]
             else:
-                raise Exception("Unrecognized parsing state.")
+                raise Exception("Missing CODE line.")
+        elif state == CODE:
+            if line.startswith('NAME: '):
+                state = NAME
+                name = line.split(None, 1)[1]
+            else:
+                raise Exception("Missing NAME line.")
+        elif state == NAME:
+            if line.startswith('WEIGHT: '):
+                state = WEIGHT
+                weight = int(round(float(line.split(None, 1)[1]) *
+                                   WEIGHT_SCALE))
+            else:
+                raise Exception("Missing WEIGHT line.")
+        elif state == WEIGHT:
+            if line == 'ITEM END':
+                state = INVENTORY
+                inventory[code] = Item(code, name, weight)
+            else:
+                raise Exception("Missing ITEM END line.")
+        elif state == END:
+            raise Exception("Found a line after INVENTORY END line.")
+        else:
+            raise Exception("Unrecognized parsing state.")
 
     return inventory
 
 
-def read_order(filename):
+def parse_order_number(value, fields):
+    fields['number'] = int(value)
+
+
+def parse_customer_code(value, fields):
+    fields['customer_code'] = value
+
+
+def parse_order_item(value, fields):
+    # split '<code>, <qty>' with plain string ops.
+    comma = value.rfind(', ')
+    if comma == -1:
+        raise Exception("Malformed ITEM line.")
+    item_code = value[:comma].lstrip()
+    qty = int(value[comma + 2:])
+    fields['line_items'].append(LineItem(item_code, qty))
+
+
+# read_order states, named for the line expected next
+(EXPECT_START, EXPECT_NUMBER, EXPECT_CUSTOMER, EXPECT_ITEM,
+ AFTER_END) = range(1, 6)
+# (state, keyword, separator) -> (next state, value handler), where a line is
+# split into keyword, separator and value by line.partition(': ').
+order_transitions = {
+    (EXPECT_START, 'ORDER START', ''): (EXPECT_NUMBER, None),
+    (EXPECT_NUMBER, 'ORDER NUMBER', ': '):
+        (EXPECT_CUSTOMER, parse_order_number),
+    (EXPECT_CUSTOMER, 'CUSTOMER CODE', ': '):
+        (EXPECT_ITEM, parse_customer_code),
+    (EXPECT_ITEM, 'ITEM', ': '): (EXPECT_ITEM, parse_order_item),
+    (EXPECT_ITEM, 'ORDER END', ''): (AFTER_END, None),
+}
+# the error for a line with no transition from a state
+order_errors = {
+    EXPECT_START: "Missing ORDER START line.",
+    EXPECT_NUMBER: "Missing ORDER NUMBER line.",
+    EXPECT_CUSTOMER: "Missing CUSTOMER CODE line.",
+    EXPECT_ITEM: "Expected ITEM or ORDER END line.",
+    AFTER_END: "Found a line after ORDER END line.",
+}
 
-    START, ORDER, NUMBER, CODE, ITEM, END = range(1, 7)
-    state = START
-    line_items = []
-    lineitem_regex = re.compile(r'^ITEM:\s+(.+?),\s+(.+)$')
 
+def read_order(filename):
+    '''
+    Parse an order file.
+    Return an Order.
+    '''
     with open(filename) as fh:
-        for line in fh:
-            line = line.strip()
-            if not line:
-                continue # skip blank lines
-
-            if state == START:
-                if line == 'ORDER START':
-                    state = ORDER
-                else:
-                    raise Exception("Missing ORDER START line.")
-            elif state == ORDER:
-                if line.startswith('ORDER NUMBER: '):
-                    state = CODE
-                    number = int(line.split(': ', 1)[1])
-                else:
-                    raise Exception("Missing ORDER NUMBER line.")
-            elif state == CODE:
-                if line.startswith('CUSTOMER CODE: '):
-                    state = ITEM
-                    customer_code = line.split(': ', 1)[1]
-                else:
-                    raise Exception("Missing CUSTOMER CODE line.")
-            elif state == ITEM:
-                if line.startswith('ITEM: '):
-                    # Stay in ITEM state.
-                    match = lineitem_regex.search(line)
-                    item_code = match.group(1)
-                    qty = int(match.group(2))
-                    line_items.append(LineItem(item_code, qty))
-                elif line == 'ORDER END':
-                    state = END
-                else:
-                    raise Exception("Expected ITEM or ORDER END line.")
-            elif state == END:
-                raise Exception("Found a line after ORDER END line.")
-            else:
-                raise Exception("Unrecognized parsing state.")
+        lines = fh.read().splitlines()
+
+    state = EXPECT_START
+    fields = {'line_items': []}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue # skip blank lines
 
-    return Order(number, customer_code, line_items)
+        keyword, sep, value = line.partition(': ')
+        transition = order_transitions.get((state, keyword, sep))
+        if transition is None:
+            raise Exception(order_errors[state])
+        state, handler = transition
+        if handler is not None:
+            handler(value, fields)
+
+    # the order must at least get as far as its line items
+    if state not in (EXPECT_ITEM, AFTER_END):
+        raise Exception(order_errors[state])
+
+    return Order(fields['number'], fields['customer_code'],
+                 fields['line_items'])
 
 
 class Bin:
     '''
-    A bin contains items and a sum of their weights.
+    A bin contains counts of items by code and a sum of their weights.
     This class is used by the bin packing algorithm.
     '''
+    __slots__ = ('counts', 'weight')
+
     def __init__(self):
-        self.items = []
+        self.counts = {}
         self.weight = 0
 
-    def add(self, item):
-        self.items.append(item)
-        self.weight += item.weight
+    def add(self, code, weight, qty):
+        '''
+        Add qty items of the given code and (unit) weight.
+        '''
+        self.counts[code] = self.counts.get(code, 0) + qty
+        self.weight += weight * qty
 
     def __repr__(self):
-        return 'Bin: %r, %r' % (self.weight, self.items)
+        return 'Bin: %s, %r' % (format_weight(self.weight), self.counts)
+
+
+class FirstFitTree:
+    '''
+    A segment tree over bin positions storing the maximum remaining
+    capacity of the bins under each node.  Finding the first (leftmost) bin
+    that can fit a weight is a single root-to-leaf descent, O(log m), instead
+    of a linear scan over all m bins.
+
+    Leaves past the last open bin hold the full capacity, so the first fit for
+    an item that fits in no open bin is the next, not yet opened, bin.  When
+    every leaf is in use the tree doubles, so it only ever holds O(m) leaves.
+    '''
+    __slots__ = ('capacity', 'size', 'tree')
+
+    def __init__(self, n, capacity):
+        '''
+        n: int.  the initial number of bins.
+        capacity: int.  the capacity of an empty bin, in 1/WEIGHT_SCALE units.
+        '''
+        size = 1
+        while size < n:
+            size *= 2
+        self.capacity = capacity
+        self.size = size
+        self.tree = [capacity] * (2 * size)
+
+    def grow(self):
+        '''
+        Double the number of leaves, adding empty bins on the right.
+        '''
+        size = self.size
+        leaves = self.tree[size:] + [self.capacity] * size
+        size *= 2
+        tree = [0] * size + leaves
+        for i in range(size - 1, 0, -1):
+            tree[i] = max(tree[2 * i], tree[2 * i + 1])
+        self.size = size
+        self.tree = tree
+
+    def fill(self, weight, qty):
+        '''
+        Put as many of qty units of weight as fit into the first bin that
+        can fit one.  The lookup and the update share one pass down and back
+        up the tree.
+        Return (index, count), the bin index and the number of units placed.
+        '''
+        # make room for a new bin if weight fits in no leaf
+        while self.tree[1] < weight:
+            self.grow()
+        tree = self.tree
+        size = self.size
+
+        # descend to the leftmost leaf that fits.  the comparison picks the
+        # child directly, rather than branching on it.
+        i = 1
+        while i < size:
+            i = 2 * i + (tree[2 * i] < weight)
+        index = i - size
+
+        # fill the bin with as many units as fit
+        # (int weights make the division exact)
+        if weight:
+            count = min(qty, tree[i] // weight)
+        else:
+            count = qty
+        tree[i] -= weight * count
+
+        # update the maxima above the leaf, stopping once one is unchanged
+        i //= 2
+        while i:
+            m = max(tree[2 * i], tree[2 * i + 1])
+            if tree[i] == m:
+                break
+            tree[i] = m
+            i //= 2
+
+        return index, count
+
+
+def first_fit_pack(weights, quantities, capacity, nbins=1):
+    '''
+    Pack quantities of weights, in the given order, into bins of the given
+    capacity using first-fit.  weights and quantities can be any iterables.
+    This works on plain numbers only, keeping object attribute access out of
+    the packing loop.
+
+    weights, capacity: ints, in 1/WEIGHT_SCALE units, as read_inventory and
+      scale_weight produce.  Integer arithmetic keeps the packing exact.
 
+    nbins: int.  the expected number of bins, used to pre-size the search
+      tree.  it grows as needed if more bins are used.
 
-def first_fit_descending_pack(items, capacity):
-    sorted_items = sorted(items, key=lambda i: i.weight, reverse=True)
-    print('sorted items:', sorted_items)
-    bins = []
+    Identical units would each go to the first bin that fits them, so all
+    the units of a weight that fit in a bin are placed at once, rather than
+    one at a time.
 
-    for item in sorted_items:
-        if item.weight > capacity:
+    Return a list of (index, bin, count) placements, meaning count units of
+    weights[index] go in bin.
+    '''
+    placements = []
+    fill = FirstFitTree(nbins, capacity).fill
+
+    for index, (weight, qty) in enumerate(zip(weights, quantities)):
+        if weight > capacity:
             raise Exception("Error: Item size greater than bin capacity.")
 
-        # find first bin (if any) that can fit item
-        the_bin = None
-        for bin_ in bins:
-            if item.weight <= capacity - bin_.weight:
-                the_bin = bin_
-                break
+        while qty > 0:
+            # the first bin (if any) that can fit weight, or the next new bin
+            # if weight fits in no current bin.
+            i, count = fill(weight, qty)
+            placements.append((index, i, count))
+            qty -= count
 
-        # create a new bin if item fits in no current bin
-        if the_bin is None:
-            the_bin = Bin()
-            bins.append(the_bin)
+    return placements
 
-        # assign item to the bin
-        the_bin.add(item)
+
+def uniform_pack(quantities, per_bin):
+    '''
+    Pack quantities of items that all have the same weight, per_bin of them to
+    a bin.  With a single weight, first-fit just fills each bin in turn, so no
+    search is needed.
+    Return a list of placements, as first_fit_pack does.
+    '''
+    placements = []
+    i = 0
+    room = per_bin
+    for index, qty in enumerate(quantities):
+        while qty > 0:
+            count = min(qty, room)
+            placements.append((index, i, count))
+            qty -= count
+            room -= count
+            if room == 0:
+                i += 1
+                room = per_bin
+
+    return placements
+
+
+def first_fit_descending_pack(codes, weights, quantities, capacity):
+    '''
+    Pack items given as parallel lists of item codes, unit weights and
+    quantities, heaviest first.  Weights and capacity are ints, in
+    1/WEIGHT_SCALE units.
+    Return a list of Bins.
+    '''
+    # sort the parallel lists together by weight
+    order = sorted(range(len(weights)), key=weights.__getitem__, reverse=True)
+    codes = [codes[j] for j in order]
+    weights = [weights[j] for j in order]
+    quantities = [quantities[j] for j in order]
+
+    if weights and weights[0] == weights[-1] and 0 < weights[0] <= capacity:
+        # every item weighs the same (the list is sorted), e.g. an order for
+        # a single item code.
+        placements = uniform_pack(quantities, capacity // weights[0])
+    else:
+        # no packing can use fewer bins than the total weight needs, so
+        # pre-size the search tree for that many.
+        total = sum(weight * qty for weight, qty in zip(weights, quantities))
+        min_bins = -(-total // capacity) if capacity > 0 else 1
+        placements = first_fit_pack(weights, quantities, capacity, min_bins)
+
+    # rebuild the bins from the placements
+    nbins = max((i for index, i, count in placements), default=-1) + 1
+    bins = [Bin() for i in range(nbins)]
+    for index, i, count in placements:
+        bins[i].add(codes[index], weights[index], count)
 
     return bins
 
 
 def make_pickship(order, inventory, capacity):
-    # Unroll order into a list of items
-    items = []
-    for li in order.line_items:
-        item = inventory[li.code]
-        for i in range(li.qty):
-            items.append(item)
+    # lay the order out as parallel lists, looking up each item once
+    codes = [li.code for li in order.line_items]
+    weights = [inventory[code].weight for code in codes]
+    quantities = [li.qty for li in order.line_items]
 
     # pack items into bins
-    bins = first_fit_descending_pack(items, capacity)
-    
+    bins = first_fit_descending_pack(codes, weights, quantities, capacity)
+
     # reroll binned items into a pick ship
+    # the bins already know their weights, so boxes need no inventory lookups
     boxes = []
+    weight = 0
     for i, bin_ in enumerate(bins):
-        c = collections.Counter(item.code for item in bin_.items)
-        line_items = [LineItem(code, qty) for code, qty in c.items()]
-        boxes.append(Box(i, line_items, inventory))
+        line_items = [LineItem(code, qty) for code, qty in bin_.counts.items()]
+        boxes.append(Box(i, line_items, bin_.weight))
+        weight += bin_.weight
+
+    return PickShip(order.number, boxes, weight)
+
+
+def pack_work(order, inventory, capacity):
+    '''
+    Estimate the work of packing an order: one step per line item, plus one
+    per bin, counting the fewest bins its total weight needs.
+    '''
+    total = sum(inventory[li.code].weight * li.qty for li in order.line_items)
+    min_bins = -(-total // capacity) if capacity > 0 else 0
+    return len(order.line_items) + min_bins
+
+
+# Packing costs a few us per step of pack_work, and starting a worker pool
+# takes 15-25 ms, so batches with less work than this are packed serially.
+PARALLEL_MIN_WORK = 10000
+
+
+def make_pickships(orders, inventory, capacity, max_workers=None):
+    '''
+    Make a PickShip for each of several orders.  Orders are packed
+    independently, so batches with enough work are spread across a pool of
+    worker processes, at most one per order.
+    Return a list of PickShips, in the same order as orders.
+    '''
+    workers = min(max_workers or os.cpu_count() or 1, len(orders))
+    if (workers < 2 or
+            sum(pack_work(order, inventory, capacity) for order in orders)
+            < PARALLEL_MIN_WORK):
+        return [make_pickship(order, inventory, capacity) for order in orders]
 
-    return PickShip(order.number, boxes)
+    # give each worker one chunk of orders, so the inventory (part of pack)
+    # is sent once per worker rather than once per order.
+    chunksize = -(-len(orders) // workers)
+    pack = functools.partial(make_pickship, inventory=inventory,
+                             capacity=capacity)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(pack, orders, chunksize=chunksize))
 
 
 def write_pickship(pickship, handle=sys.stdout):
-    handle.write("PICK SHIP START\n")
-    handle.write("ORDER NUMBER: %s\n" % pickship.order_number)
-    handle.write("TOTAL SHIP WEIGHT: %s\n" % pickship.weight)
+    # an order with no boxes has a plain 0 total, as an empty sum
+    if pickship.boxes:
+        total = format_weight(pickship.weight)
+    else:
+        total = 0
+    parts = ["PICK SHIP START\n",
+             f"ORDER NUMBER: {pickship.order_number}\n",
+             f"TOTAL SHIP WEIGHT: {total}\n"]
     for box in pickship.boxes:
-        handle.write('BOXSTART: %s\n' % (box.number + 1))
-        handle.write('SHIP WEIGHT: %s\n' % box.weight)
+        parts.append(f"BOXSTART: {box.number + 1}\n")
+        parts.append(f"SHIP WEIGHT: {format_weight(box.weight)}\n")
         for li in box.line_items:
-            handle.write('ITEM: %s, %s\n' % (li.code, li.qty))
-        handle.write('BOX END\n')
-    handle.write("PICK SHIP END\n")
+            parts.append(f"ITEM: {li.code}, {li.qty}\n")
+        parts.append("BOX END\n")
+    parts.append("PICK SHIP END\n")
+    handle.write("".join(parts))
 
 
 def main():
 
-    parser = argparse.ArgumentParser(description='Create a pick-and-ship list for a given order and inventory.')
+    parser = argparse.ArgumentParser(description='Create a pick-and-ship list for each given order and an inventory.')
     parser.add_argument('inventory', help='A pickship-format inventory text file')
-    parser.add_argument('order', help='A pickship-format order text file.')
+    parser.add_argument('order', nargs='+',
+                        help='One or more pickship-format order text files.')
     parser.add_argument('--capacity', type=int, default=10,
                         help='The maximum weight capacity of each box.')
     args = parser.parse_args()
@@ -262,17 +555,22 @@ def main():
     print('Parsing inventory:', args.inventory)
     inventory = read_inventory(args.inventory)
     print(inventory)
-    # read order
-    print('Parsing order:', args.order)
-    order = read_order(args.order)
-    print(order)
-    # make pickship
-    print('Making pick-and-ship list.')
-    pickship = make_pickship(order, inventory, args.capacity)
-    print(pickship)
-    # write pickship
-    print('Writing pick-and-ship list.')
-    write_pickship(pickship)
+    # read orders
+    orders = []
+    for filename in args.order:
+        print('Parsing order:', filename)
+        order = read_order(filename)
+        print(order)
+        orders.append(order)
+    # make pickships
+    print('Making pick-and-ship lists.')
+    pickships = make_pickships(orders, inventory, scale_weight(args.capacity))
+    for pickship in pickships:
+        print(pickship)
+    # write pickships
+    print('Writing pick-and-ship lists.')
+    for pickship in pickships:
+        write_pickship(pickship)
 
 
 